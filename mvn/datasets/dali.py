@@ -0,0 +1,161 @@
+import numpy as np
+
+import torch
+
+try:
+    from nvidia.dali.pipeline import Pipeline
+    from nvidia.dali import fn, types
+    from nvidia.dali.plugin.pytorch import feed_ndarray
+except ImportError:
+    Pipeline = None
+
+from mvn.utils.img import IMAGENET_MEAN, IMAGENET_STD
+
+
+def build_image_pipeline(image_shape, max_batch_size, num_threads=4, device_id=None):
+    """Builds DALI pipeline which decodes, crops, resizes and normalizes a batch of jpeg images
+
+    Args:
+        image_shape tuple of size 2: output (height, width)
+        max_batch_size int: maximum number of images fed in one run
+        num_threads int: number of DALI CPU threads
+        device_id int or None: GPU to run on. If None, everything is done on CPU
+
+    Returns:
+        pipeline: built pipeline with external sources 'jpegs', 'anchors' and 'shapes'
+    """
+    if Pipeline is None:
+        raise ImportError("NVIDIA DALI is not installed, see https://docs.nvidia.com/deeplearning/dali")
+
+    decoder_device = "cpu" if device_id is None else "mixed"
+
+    # inputs are fed right before each run(), so nothing can be prefetched
+    pipeline = Pipeline(
+        batch_size=max_batch_size, num_threads=num_threads, device_id=device_id,
+        exec_pipelined=False, exec_async=False, prefetch_queue_depth=1
+    )
+    with pipeline:
+        jpegs = fn.external_source(name="jpegs", dtype=types.UINT8)
+        anchors = fn.external_source(name="anchors", dtype=types.INT32)  # (left, upper) in pixels
+        shapes = fn.external_source(name="shapes", dtype=types.INT32)  # (width, height) in pixels
+
+        # BGR to stay consistent with cv2.imread
+        images = fn.decoders.image(jpegs, device=decoder_device, output_type=types.BGR)
+
+        # same as crop_image(): bbox may go out of the image, missing parts are filled with zeros
+        images = fn.slice(
+            images, anchors, shapes,
+            axis_names="WH", normalized_anchor=False, normalized_shape=False,
+            out_of_bounds_policy="pad", fill_values=0
+        )
+
+        # DALI has no cv2.INTER_AREA, antialiased linear is the closest filter for downscaling
+        images = fn.resize(
+            images, resize_x=image_shape[1], resize_y=image_shape[0],
+            interp_type=types.INTERP_LINEAR, antialias=True
+        )
+
+        # same as normalize_image(), but fused with HWC -> CHW
+        images = fn.crop_mirror_normalize(
+            images,
+            dtype=types.FLOAT,
+            output_layout="CHW",
+            mean=list(255.0 * IMAGENET_MEAN),
+            std=list(255.0 * IMAGENET_STD)
+        )
+
+        pipeline.set_outputs(images)
+
+    pipeline.build()
+
+    return pipeline
+
+
+class DALIMultiViewLoader:
+    """
+        Wraps a DataLoader over `Human36MMultiViewDataset(load_images=False)` and fills
+        `batch['images']` with a (batch_size, n_views, 3, height, width) tensor decoded by DALI
+        (with nvJPEG if `device_id` is given, on CPU otherwise). Encoded images are read from
+        files or shards by the dataset, i.e. in DataLoader workers, and come in `batch['jpegs']`.
+
+        Images are resized with antialiased linear interpolation instead of cv2.INTER_AREA used by
+        `Human36MMultiViewDataset.load_image()`, so they are close but not identical to CPU-loaded
+        ones; keep this in mind when evaluating models trained on the other path.
+
+        If `check_first_batch` is set, the first batch is compared against `load_image()` and an
+        AssertionError is raised if they clearly differ (e.g. wrong crops giving black images).
+    """
+    def __init__(self, dataloader, num_threads=4, device_id=None, check_first_batch=True):
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.device_id = device_id
+        self.check_first_batch = check_first_batch
+
+        assert not self.dataset.load_images, "Construct the dataset with `load_images=False`"
+        assert self.dataset.norm_image, "DALI pipeline always normalizes images"
+
+        n_cameras = len(self.dataset.labels['camera_names'])
+        self.pipeline = build_image_pipeline(
+            self.dataset.image_shape,
+            max_batch_size=dataloader.batch_size * n_cameras,
+            num_threads=num_threads,
+            device_id=device_id
+        )
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        for batch in self.dataloader:
+            if batch is not None:
+                batch['images'] = self.load_images(batch)
+
+                if self.check_first_batch:
+                    self.check_batch(batch)
+                    self.check_first_batch = False
+
+            yield batch
+
+    def load_images(self, batch):
+        batch_size, n_views = len(batch['indexes']), len(batch['cameras'])
+
+        jpegs, anchors, shapes = [], [], []
+        for batch_i in range(batch_size):
+            for view_i in range(n_views):
+                left, upper, right, lower = batch['detections'][batch_i][view_i][:4]
+
+                jpegs.append(batch['jpegs'][batch_i][view_i])
+                anchors.append(np.array([left, upper], dtype=np.int32))
+                shapes.append(np.array([right - left, lower - upper], dtype=np.int32))
+
+        self.pipeline.feed_input("jpegs", jpegs)
+        self.pipeline.feed_input("anchors", anchors)
+        self.pipeline.feed_input("shapes", shapes)
+        images, = self.pipeline.run()
+
+        images = images.as_tensor()
+        if self.device_id is None:
+            images = torch.from_numpy(np.array(images))
+        else:
+            images_torch = torch.empty(images.shape(), dtype=torch.float32, device=torch.device('cuda', self.device_id))
+            feed_ndarray(images, images_torch)
+            images = images_torch
+
+        return images.view(batch_size, n_views, *images.shape[1:])
+
+    def check_batch(self, batch, max_mean_abs_diff=0.1):
+        """Compares DALI images in `batch` with the same views loaded by `Human36MMultiViewDataset.load_image()`"""
+        camera_names = self.dataset.labels['camera_names']
+        dali_images = batch['images'].cpu().numpy()
+
+        for batch_i, idx in enumerate(batch['indexes']):
+            for view_i, camera_batch in enumerate(batch['cameras']):
+                camera_idx = camera_names.index(camera_batch[batch_i].name)
+                bbox = tuple(int(x) for x in batch['detections'][batch_i][view_i][:4])
+
+                image, _ = self.dataset.load_image(idx, camera_idx, bbox)
+
+                mean_abs_diff = np.abs(dali_images[batch_i, view_i] - image).mean()
+                assert mean_abs_diff < max_mean_abs_diff, \
+                    f"DALI image of sample {idx}, camera {camera_names[camera_idx]} differs from " \
+                    f"the CPU one by {mean_abs_diff:.3f} on average"
@@ -1,16 +1,20 @@
 import os
-from collections import defaultdict
 import pickle
+import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import cv2
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 
 from mvn.utils.multiview import Camera
-from mvn.utils.img import get_square_bbox, resize_image, crop_image, normalize_image, scale_bbox
+from mvn.utils.img import get_square_bbox, resize_image, crop_image, normalize_image, scale_bboxes, read_image, decode_image
 from mvn.utils import volumetric
+from mvn.utils.misc import LRUCache
+from mvn.datasets import utils as dataset_utils
+from mvn.datasets.shards import ImageShards, labels_table_checksum
 
 
 class Human36MMultiViewDataset(Dataset):
@@ -32,7 +36,11 @@ class Human36MMultiViewDataset(Dataset):
                  kind="mpii",
                  undistort_images=False,
                  ignore_cameras=[],
-                 crop=True
+                 crop=True,
+                 load_images=True,
+                 image_cache_capacity=0,
+                 shards_path=None,
+                 emit_cuboids=False
                  ):
         """
             h36m_root:
@@ -49,12 +57,34 @@ class Human36MMultiViewDataset(Dataset):
                 If `True`, will include 'S9/[Greeting-2,SittingDown-2,Waiting-1]' in test set.
             kind:
                 Keypoint format, 'mpii' or 'human36m'
+            norm_image:
+                If `True`, images are normalized float32 arrays of shape (3, h, w),
+                otherwise they are BGR uint8 arrays of shape (h, w, 3)
             ignore_cameras:
                 A list with indices of cameras to exclude (0 to 3 inclusive)
+            load_images:
+                If `False`, images are not decoded: `sample['images']` is omitted and `sample['jpegs']` holds
+                encoded views (uint8 arrays, from files or shards); cameras are still updated as if images
+                were cropped and resized. Used when images are decoded elsewhere, e.g. by
+                `mvn.datasets.dali.DALIMultiViewLoader`. Requires `crop=True` and `image_shape`.
+            image_cache_capacity:
+                Number of preprocessed (cropped, resized and normalized) images to keep in an LRU cache.
+                The cache lives in each DataLoader worker, so it survives epochs only with persistent workers.
+                0 disables caching.
+            shards_path:
+                Directory with images packed by 'pack-images-to-shards.py' for this `labels_path`.
+                If set, images are read from memory-mapped shards instead of separate jpeg files.
+            emit_cuboids:
+                If `True`, `sample['cuboids']` holds a `cuboid_side`-sized `Cuboid3D` around the pelvis.
+                Off by default, as the models build their own cuboids.
         """
         assert train or test, '`Human36MMultiViewDataset` must be constructed with at least ' \
                               'one of `test=True` / `train=True`'
         assert kind in ("mpii", "human36m")
+        assert load_images or (crop and image_shape is not None), \
+            '`load_images=False` requires `crop=True` and a fixed `image_shape`'
+        assert load_images or image_cache_capacity == 0, \
+            '`image_cache_capacity` caches decoded images, so it has no effect with `load_images=False`'
 
         self.h36m_root = h36m_root
         self.labels_path = labels_path
@@ -62,13 +92,33 @@ class Human36MMultiViewDataset(Dataset):
         self.scale_bbox = scale_bbox
         self.norm_image = norm_image
         self.cuboid_side = cuboid_side
+        self.emit_cuboids = emit_cuboids
         self.kind = kind
         self.undistort_images = undistort_images
         self.ignore_cameras = ignore_cameras
         self.crop = crop
+        self.load_images = load_images
+        self._image_cache = LRUCache(image_cache_capacity)
+        self._view_pool, self._view_pool_pid = None, None
 
         self.labels = np.load(labels_path, allow_pickle=True).item()
 
+        self._image_shards = None
+        if shards_path is not None:
+            self._image_shards = ImageShards(shards_path)
+            assert self._image_shards.labels_table_checksum == labels_table_checksum(self.labels['table']), \
+                f"'{shards_path}' was built for another labels file"
+            assert self._image_shards.undistort_images == self.undistort_images, \
+                f"'{shards_path}' was built with undistort_images={self._image_shards.undistort_images}"
+
+        # choose the image source once instead of checking it for every view
+        if self._image_shards is not None:
+            self._read_view_image = self._read_image_from_shards
+            self._read_view_jpeg = self._read_jpeg_from_shards
+        else:
+            self._read_view_image = self._read_image_from_file
+            self._read_view_jpeg = self._read_jpeg_from_file
+
         n_cameras = len(self.labels['camera_names'])
         assert all(camera_idx in range(n_cameras) for camera_idx in self.ignore_cameras)
 
@@ -78,25 +128,65 @@ class Human36MMultiViewDataset(Dataset):
         train_subjects = list(self.labels['subject_names'].index(x) for x in train_subjects)
         test_subjects  = list(self.labels['subject_names'].index(x) for x in test_subjects)
 
-        indices = []
+        def make_lut(n, true_indices):
+            # boolean lookup table: much cheaper than `np.isin` for a handful of small integer ids
+            lut = np.zeros(n, dtype=bool)
+            lut[true_indices] = True
+            return lut
+
+        subject_idx = self.labels['table']['subject_idx']
+        n_subjects = len(self.labels['subject_names'])
+
+        masks_and_strides = []
         if train:
-            mask = np.isin(self.labels['table']['subject_idx'], train_subjects, assume_unique=True)
-            indices.append(np.nonzero(mask)[0])
+            mask = make_lut(n_subjects, train_subjects)[subject_idx]
+            masks_and_strides.append((mask, 1))
         if test:
-            mask = np.isin(self.labels['table']['subject_idx'], test_subjects, assume_unique=True)
+            mask = make_lut(n_subjects, test_subjects)[subject_idx]
 
             if not with_damaged_actions:
-                mask_S9 = self.labels['table']['subject_idx'] == self.labels['subject_names'].index('S9')
+                mask_S9 = subject_idx == self.labels['subject_names'].index('S9')
 
                 damaged_actions = 'Greeting-2', 'SittingDown-2', 'Waiting-1'
                 damaged_actions = [self.labels['action_names'].index(x) for x in damaged_actions]
-                mask_damaged_actions = np.isin(self.labels['table']['action_idx'], damaged_actions)
+                action_lut = make_lut(len(self.labels['action_names']), damaged_actions)
+                mask_damaged_actions = action_lut[self.labels['table']['action_idx']]
 
                 mask &= ~(mask_S9 & mask_damaged_actions)
 
-            indices.append(np.nonzero(mask)[0][::retain_every_n_frames_in_test])
+            masks_and_strides.append((mask, retain_every_n_frames_in_test))
 
-        self.labels['table'] = self.labels['table'][np.concatenate(indices)]
+        if len(masks_and_strides) == 1 and masks_and_strides[0][1] == 1:
+            selection = masks_and_strides[0][0]
+        else:
+            selection = np.concatenate([np.flatnonzero(mask)[::stride] for mask, stride in masks_and_strides])
+
+        self.labels['table'] = self.labels['table'][selection]
+        if self._image_shards is not None:
+            self._image_shards.select(selection)
+
+        # precompute scaled bounding boxes for all shots and cameras
+        self._view_is_missing = dataset_utils.get_missing_views_mask(self.labels['table']['bbox_by_camera_tlbr'])
+        bboxes = self.labels['table']['bbox_by_camera_tlbr'][..., [1,0,3,2]] # TLBR to LTRB
+        self._bboxes_scaled = scale_bboxes(bboxes, self.scale_bbox)
+
+        # image paths differ only in frame number within a (subject, action, camera)
+        self._image_path_prefixes = np.empty(
+            (len(self.labels['subject_names']), len(self.labels['action_names']), n_cameras), dtype=object)
+        for subject_idx, subject in enumerate(self.labels['subject_names']):
+            for action_idx, action in enumerate(self.labels['action_names']):
+                for camera_idx, camera_name in enumerate(self.labels['camera_names']):
+                    self._image_path_prefixes[subject_idx, action_idx, camera_idx] = os.path.join(
+                        self.h36m_root, subject, action, 'imageSequence' + '-undistorted' * self.undistort_images,
+                        camera_name, 'img_')
+
+        # cameras are the same for all shots of a subject, so build them only once
+        self._cameras = {}
+        for subject_idx in np.unique(self.labels['table']['subject_idx']):
+            for camera_idx, camera_name in enumerate(self.labels['camera_names']):
+                shot_camera = self.labels['cameras'][subject_idx, camera_idx]
+                self._cameras[subject_idx, camera_idx] = \
+                    Camera(shot_camera['R'], shot_camera['t'], shot_camera['K'], shot_camera['dist'], camera_name)
 
         self.num_keypoints = 16 if kind == "mpii" else 17
         assert self.labels['table']['keypoints'].shape[1] == 17, "Use a newer 'labels' file"
@@ -113,71 +203,197 @@ class Human36MMultiViewDataset(Dataset):
     def __len__(self):
         return len(self.labels['table'])
 
-    def __getitem__(self, idx):
-        sample = defaultdict(list) # return value
+    @staticmethod
+    def make_dataloader(dataset, batch_size, shuffle, num_workers=None, pin_memory=True,
+                        persistent_workers=True, prefetch_factor=4, **kwargs):
+        """Builds a DataLoader with sensible defaults for this dataset
+
+        Args:
+            num_workers: if None, uses min(number of CPUs, 8)
+            persistent_workers: keep workers (and their image caches) alive between epochs
+            prefetch_factor: batches loaded in advance by each worker; larger values
+                give diminishing returns and risk running out of memory
+            **kwargs: passed to DataLoader, e.g. `sampler` or `collate_fn`
+        """
+        if num_workers is None:
+            num_workers = min(os.cpu_count() or 1, 8)
+
+        kwargs.setdefault('collate_fn', dataset_utils.make_collate_fn(randomize_n_views=False))
+        kwargs.setdefault('worker_init_fn', dataset_utils.worker_init_fn)
+
+        # these are only allowed with multiprocessing loading
+        if num_workers > 0:
+            kwargs['persistent_workers'] = persistent_workers
+            kwargs['prefetch_factor'] = prefetch_factor
+
+        return DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            **kwargs
+        )
+
+    def get_image_path(self, idx, camera_idx):
         shot = self.labels['table'][idx]
+        prefix = self._image_path_prefixes[shot['subject_idx'], shot['action_idx'], camera_idx]
+        return prefix + '%06d.jpg' % (shot['frame_idx']+1)
+
+    def _read_image_from_file(self, idx, camera_idx):
+        image_path = self.get_image_path(idx, camera_idx)
+        image = read_image(image_path)
+        assert image is not None, '%s doesn\'t exist' % image_path
+        return image
+
+    def _read_image_from_shards(self, idx, camera_idx):
+        return decode_image(self._image_shards.get(idx, camera_idx))
+
+    def _read_jpeg_from_file(self, idx, camera_idx):
+        return np.fromfile(self.get_image_path(idx, camera_idx), dtype=np.uint8)
 
-        subject = self.labels['subject_names'][shot['subject_idx']]
-        action = self.labels['action_names'][shot['action_idx']]
-        frame_idx = shot['frame_idx']
+    def _read_jpeg_from_shards(self, idx, camera_idx):
+        # copy, so that the sample doesn't reference the whole memory-mapped shard
+        return np.array(self._image_shards.get(idx, camera_idx))
 
-        for camera_idx, camera_name in enumerate(self.labels['camera_names']):
-            if camera_idx in self.ignore_cameras:
-                continue
+    def load_image(self, idx, camera_idx, bbox):
+        """Reads, crops, resizes and normalizes one view according to the dataset settings
 
-            # load bounding box
-            bbox = shot['bbox_by_camera_tlbr'][camera_idx][[1,0,3,2]] # TLBR to LTRB
-            bbox_height = bbox[2] - bbox[0]
-            if bbox_height == 0:
-                # convention: if the bbox is empty, then this view is missing
-                continue
+        Returns:
+            image numpy array: preprocessed image, must not be modified as it may be cached
+            image_shape_before_resize tuple of size 2 or None: (height, width) before resize
+        """
+        cache_key = None
+        if self._image_cache.capacity > 0:
+            cache_key = (self.get_image_path(idx, camera_idx), bbox, self.image_shape)
+            cached = self._image_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        image = self._read_view_image(idx, camera_idx)
+
+        if self.crop:
+            image = crop_image(image, bbox)
+
+        image_shape_before_resize = None
+        if self.image_shape is not None:
+            image_shape_before_resize = image.shape[:2]
+            image = resize_image(image, self.image_shape)
+
+        if self.norm_image:
+            # HxWxC -> CxHxW as expected by the networks
+            image = normalize_image(image, channels_first=True)
 
-            # scale the bounding box
-            bbox = scale_bbox(bbox, self.scale_bbox)
+        if cache_key is not None:
+            image.flags.writeable = False
+            self._image_cache.put(cache_key, (image, image_shape_before_resize))
 
-            # load image
-            image_path = os.path.join(
-                self.h36m_root, subject, action, 'imageSequence' + '-undistorted' * self.undistort_images,
-                camera_name, 'img_%06d.jpg' % (frame_idx+1))
-            assert os.path.isfile(image_path), '%s doesn\'t exist' % image_path
-            image = cv2.imread(image_path)
+        return image, image_shape_before_resize
 
-            # load camera
-            shot_camera = self.labels['cameras'][shot['subject_idx'], camera_idx]
-            retval_camera = Camera(shot_camera['R'], shot_camera['t'], shot_camera['K'], shot_camera['dist'], camera_name)
+    def _get_view_pool(self):
+        # created lazily and per process: threads don't survive the fork of DataLoader workers
+        if self._view_pool is None or self._view_pool_pid != os.getpid():
+            self._view_pool = ThreadPoolExecutor(max_workers=len(self.labels['camera_names']))
+            self._view_pool_pid = os.getpid()
 
-            if self.crop:
-                # crop image
-                image = crop_image(image, bbox)
-                retval_camera.update_after_crop(bbox)
+        return self._view_pool
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view_pool'] = None
+        return state
+
+    def _load_view(self, idx, camera_idx):
+        shot = self.labels['table'][idx]
+
+        # load scaled bounding box
+        bbox = tuple(self._bboxes_scaled[idx, camera_idx].tolist())
+
+        # load image, or only read the encoded one if it is decoded elsewhere
+        image_shape_before_resize = None
+        if self.load_images:
+            image, image_shape_before_resize = self.load_image(idx, camera_idx, bbox)
+        else:
+            image = self._read_view_jpeg(idx, camera_idx)
+
+        # load camera
+        # only K is changed by `update_after_crop()` and `update_after_resize()`
+        retval_camera = copy.copy(self._cameras[shot['subject_idx'], camera_idx])
+        retval_camera.K = retval_camera.K.copy()
+
+        if self.crop:
+            retval_camera.update_after_crop(bbox)
+
+        if self.image_shape is not None:
+            if image_shape_before_resize is None:
+                image_shape_before_resize = (bbox[3] - bbox[1], bbox[2] - bbox[0])
+            retval_camera.update_after_resize(image_shape_before_resize, self.image_shape)
+
+        return image, retval_camera, bbox, image_shape_before_resize
+
+    def __getitem__(self, idx):
+        shot = self.labels['table'][idx]
+
+        camera_indices = [
+            camera_idx for camera_idx in range(len(self.labels['camera_names']))
+            if camera_idx not in self.ignore_cameras and not self._view_is_missing[idx, camera_idx]
+        ]
+        n_views = len(camera_indices)
+
+        # file reads, image decoding and resizing release the GIL, so views are loaded concurrently
+        if n_views > 1:
+            views = self._get_view_pool().map(functools.partial(self._load_view, idx), camera_indices)
+        else:
+            views = map(functools.partial(self._load_view, idx), camera_indices)
+
+        # return value
+        sample = {
+            'detections': np.empty((n_views, 5), dtype=np.float32),
+            'cameras': [],
+            'proj_matrices': np.empty((n_views, 3, 4), dtype=np.float32)
+        }
+
+        if self.load_images:
             if self.image_shape is not None:
-                # resize
-                image_shape_before_resize = image.shape[:2]
-                image = resize_image(image, self.image_shape)
-                retval_camera.update_after_resize(image_shape_before_resize, self.image_shape)
+                if self.norm_image:
+                    sample['images'] = np.empty((n_views, 3, *self.image_shape), dtype=np.float32)
+                else:
+                    sample['images'] = np.empty((n_views, *self.image_shape, 3), dtype=np.uint8)
+            else:
+                sample['images'] = [None] * n_views # sizes of original images may differ
+        else:
+            sample['jpegs'] = [None] * n_views
 
+        if self.image_shape is not None:
+            sample['image_shapes_before_resize'] = []
+
+        for view_i, (image, retval_camera, bbox, image_shape_before_resize) in enumerate(views):
+            if self.image_shape is not None:
                 sample['image_shapes_before_resize'].append(image_shape_before_resize)
 
-            if self.norm_image:
-                image = normalize_image(image)
+            if self.load_images:
+                sample['images'][view_i] = image
+            else:
+                sample['jpegs'][view_i] = image
 
-            sample['images'].append(image)
-            sample['detections'].append(bbox + (1.0,)) # TODO add real confidences
+            sample['detections'][view_i, :4] = bbox
+            sample['detections'][view_i, 4] = 1.0 # TODO add real confidences
             sample['cameras'].append(retval_camera)
-            sample['proj_matrices'].append(retval_camera.projection)
+            sample['proj_matrices'][view_i] = retval_camera.projection
 
         # 3D keypoints
         # add dummy confidences
-        sample['keypoints_3d'] = np.pad(
-            shot['keypoints'][:self.num_keypoints],
-            ((0,0), (0,1)), 'constant', constant_values=1.0)
+        keypoints_3d = np.empty((self.num_keypoints, 4), dtype=shot['keypoints'].dtype)
+        keypoints_3d[:, :3] = shot['keypoints'][:self.num_keypoints]
+        keypoints_3d[:, 3] = 1.0
+        sample['keypoints_3d'] = keypoints_3d
 
         # build cuboid
-        # base_point = sample['keypoints_3d'][6, :3]
-        # sides = np.array([self.cuboid_side, self.cuboid_side, self.cuboid_side])
-        # position = base_point - sides / 2
-        # sample['cuboids'] = volumetric.Cuboid3D(position, sides)
+        if self.emit_cuboids:
+            base_point = sample['keypoints_3d'][6, :3]
+            sides = np.array([self.cuboid_side, self.cuboid_side, self.cuboid_side])
+            position = base_point - sides / 2
+            sample['cuboids'] = volumetric.Cuboid3D(position, sides)
 
         # save sample's index
         sample['indexes'] = idx
@@ -185,7 +401,6 @@ class Human36MMultiViewDataset(Dataset):
         if self.keypoints_3d_pred is not None:
             sample['pred_keypoints_3d'] = self.keypoints_3d_pred[idx]
 
-        sample.default_factory = None
         return sample
 
     def evaluate_using_per_pose_error(self, per_pose_error, split_by_subject):
@@ -197,11 +412,15 @@ class Human36MMultiViewDataset(Dataset):
                 'Average': {'total_loss': per_pose_error[mask].sum(), 'frame_count': np.count_nonzero(mask)}
             }
 
-            for action_idx in range(len(self.labels['action_names'])):
-                action_mask = (self.labels['table']['action_idx'] == action_idx) & mask
-                action_per_pose_error = per_pose_error[action_mask]
+            # per-action sums and counts in a single pass
+            n_actions = len(self.labels['action_names'])
+            masked_action_idx = self.labels['table']['action_idx'][mask]
+            loss_per_action = np.bincount(masked_action_idx, weights=per_pose_error[mask], minlength=n_actions)
+            count_per_action = np.bincount(masked_action_idx, minlength=n_actions)
+
+            for action_idx in range(n_actions):
                 action_scores[self.labels['action_names'][action_idx]] = {
-                    'total_loss': action_per_pose_error.sum(), 'frame_count': len(action_per_pose_error)
+                    'total_loss': loss_per_action[action_idx], 'frame_count': count_per_action[action_idx]
                 }
 
             action_names_without_trials = \
@@ -227,8 +446,9 @@ class Human36MMultiViewDataset(Dataset):
             'Average': evaluate_by_actions(self, per_pose_error)
         }
 
+        table_subject_idx = self.labels['table']['subject_idx']
         for subject_idx in range(len(self.labels['subject_names'])):
-            subject_mask = self.labels['table']['subject_idx'] == subject_idx
+            subject_mask = table_subject_idx == subject_idx
             subject_scores[self.labels['subject_names'][subject_idx]] = \
                 evaluate_by_actions(self, per_pose_error, subject_mask)
 
@@ -252,7 +472,9 @@ class Human36MMultiViewDataset(Dataset):
             keypoints_3d_predicted = keypoints_3d_predicted[:, cmu_joints]
 
         # mean error per 16/17 joints in mm, for each pose
-        per_pose_error = np.sqrt(((keypoints_gt - keypoints_3d_predicted) ** 2).sum(2)).mean(1)
+        # (einsum computes squared norms without materializing the squared differences)
+        diff = keypoints_gt - keypoints_3d_predicted
+        per_pose_error = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff)).mean(1)
 
         # relative mean error per 16/17 joints in mm, for each pose
         if not (transfer_cmu_to_human36m or transfer_human36m_to_human36m):
@@ -260,10 +482,10 @@ class Human36MMultiViewDataset(Dataset):
         else:
             root_index = 0
 
-        keypoints_gt_relative = keypoints_gt - keypoints_gt[:, root_index:root_index + 1, :]
-        keypoints_3d_predicted_relative = keypoints_3d_predicted - keypoints_3d_predicted[:, root_index:root_index + 1, :]
+        # (gt - gt_root) - (pred - pred_root) == diff - diff_root, computed in place
+        np.subtract(diff, diff[:, root_index:root_index + 1, :], out=diff)
 
-        per_pose_error_relative = np.sqrt(((keypoints_gt_relative - keypoints_3d_predicted_relative) ** 2).sum(2)).mean(1)
+        per_pose_error_relative = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff)).mean(1)
 
         result = {
             'per_pose_error': self.evaluate_using_per_pose_error(per_pose_error, split_by_subject),
@@ -27,20 +27,21 @@ nesteddict = lambda: defaultdict(nesteddict)
 
 bboxes_retval = nesteddict()
 
-def load_bboxes(data_path, subject, action, camera):
+def load_bboxes(data_path, subject, action, camera, chunk_size=256):
     print(subject, action, camera)
 
-    def mask_to_bbox(mask):
-        h_mask = mask.max(0)
-        w_mask = mask.max(1)
+    def masks_to_bboxes(masks):
+        # masks: (n_frames, h, w)
+        h_masks = masks.max(1)
+        w_masks = masks.max(2)
 
-        top = h_mask.argmax()
-        bottom = len(h_mask) - h_mask[::-1].argmax()
+        top = h_masks.argmax(1)
+        bottom = h_masks.shape[1] - h_masks[:, ::-1].argmax(1)
 
-        left = w_mask.argmax()
-        right = len(w_mask) - w_mask[::-1].argmax()
+        left = w_masks.argmax(1)
+        right = w_masks.shape[1] - w_masks[:, ::-1].argmax(1)
 
-        return top, left, bottom, right
+        return np.stack([top, left, bottom, right], axis=1)
 
     try:
         try:
@@ -57,15 +58,19 @@ def load_bboxes(data_path, subject, action, camera):
             '%s.%s.mat' % (corrected_action, camera))
 
         with h5py.File(bboxes_path, 'r') as h5file:
-            retval = np.empty((len(h5file['Masks']), 4), dtype=np.int32)
-
-            for frame_idx, mask_reference in enumerate(h5file['Masks'][:,0]):
-                bbox_mask = np.array(h5file[mask_reference])
-                retval[frame_idx] = mask_to_bbox(bbox_mask)
-                
-                top, left, bottom, right = retval[frame_idx]
-                if right-left < 2 or bottom-top < 2:
-                    raise Exception(str(bboxes_path) + ' $ ' + str(frame_idx))
+            mask_references = h5file['Masks'][:,0]
+            retval = np.empty((len(mask_references), 4), dtype=np.int32)
+
+            # stack masks in chunks to bound memory and reduce each chunk at once
+            for chunk_start in range(0, len(mask_references), chunk_size):
+                chunk_references = mask_references[chunk_start:chunk_start + chunk_size]
+                bbox_masks = np.stack([np.array(h5file[mask_reference]) for mask_reference in chunk_references])
+                retval[chunk_start:chunk_start + len(chunk_references)] = masks_to_bboxes(bbox_masks)
+
+            top, left, bottom, right = retval.T
+            bad_frames = np.flatnonzero((right-left < 2) | (bottom-top < 2))
+            if len(bad_frames) > 0:
+                raise Exception(str(bboxes_path) + ' $ ' + str(bad_frames[0]))
     except Exception as ex:
         # reraise with path information
         raise Exception(str(ex) + '; %s %s %s' % (subject, action, camera))
@@ -0,0 +1,17 @@
+"""
+    Pack Human3.6M jpegs into a few large binary shards, so that `Human36MMultiViewDataset(shards_path=...)`
+    can read memory-mapped images instead of opening ~1M small files.
+
+    Usage: `python3 pack-images-to-shards.py <path/to/Human3.6M-root> <path/to/human36m-multiview-labels-*bboxes.npy> <output-dir> [--undistorted]`
+"""
+import os, sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../.."))
+from mvn.datasets.shards import build_shards
+
+h36m_root = os.path.join(sys.argv[1], "processed")
+labels_path = sys.argv[2]
+output_dir = sys.argv[3]
+undistort_images = '--undistorted' in sys.argv[4:]
+
+build_shards(h36m_root, labels_path, output_dir, undistort_images=undistort_images)
@@ -0,0 +1,111 @@
+import os
+import hashlib
+
+import numpy as np
+
+from mvn.datasets.utils import get_missing_views_mask
+
+
+INDEX_FILENAME = 'index.npy'
+
+
+def labels_table_checksum(table):
+    """MD5 of the contents of `labels['table']`, to check that shards match a labels file"""
+    return hashlib.md5(np.ascontiguousarray(table).tobytes()).hexdigest()
+
+
+def build_shards(h36m_root, labels_path, output_dir, undistort_images=False, shard_size=2 * 1024 ** 3):
+    """Packs all Human3.6M jpegs referenced by a labels file into a few large binary shard files
+
+    Shards are raw concatenations of encoded jpegs. 'index.npy' stores, for every row of
+    `labels['table']` and every camera, (shard_id, offset, length) of the image, or -1 if the view is missing.
+
+    Args:
+        h36m_root str: path to 'processed/' directory in Human3.6M
+        labels_path str: path to 'human36m-multiview-labels-*bboxes.npy'
+        output_dir str: where to write shards and index
+        undistort_images bool: pack images from 'imageSequence-undistorted' instead of 'imageSequence'
+        shard_size int: approximate maximum size of one shard in bytes
+    """
+    labels = np.load(labels_path, allow_pickle=True).item()
+    table = labels['table']
+    n_cameras = len(labels['camera_names'])
+    view_is_missing = get_missing_views_mask(table['bbox_by_camera_tlbr'])
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    index = np.full((len(table), n_cameras, 3), -1, dtype=np.int64)
+    shard_filenames = []
+
+    shard_file, shard_offset = None, 0
+    for row_idx, shot in enumerate(table):
+        subject = labels['subject_names'][shot['subject_idx']]
+        action = labels['action_names'][shot['action_idx']]
+
+        for camera_idx, camera_name in enumerate(labels['camera_names']):
+            if view_is_missing[row_idx, camera_idx]:
+                continue
+
+            image_path = os.path.join(
+                h36m_root, subject, action, 'imageSequence' + '-undistorted' * undistort_images,
+                camera_name, 'img_%06d.jpg' % (shot['frame_idx']+1))
+
+            with open(image_path, 'rb') as image_file:
+                image_bytes = image_file.read()
+
+            if shard_file is None or shard_offset + len(image_bytes) > shard_size:
+                if shard_file is not None:
+                    shard_file.close()
+
+                shard_filenames.append('shard_%03d.bin' % len(shard_filenames))
+                shard_file = open(os.path.join(output_dir, shard_filenames[-1]), 'wb')
+                shard_offset = 0
+
+            shard_file.write(image_bytes)
+            index[row_idx, camera_idx] = len(shard_filenames) - 1, shard_offset, len(image_bytes)
+            shard_offset += len(image_bytes)
+
+    if shard_file is not None:
+        shard_file.close()
+
+    np.save(os.path.join(output_dir, INDEX_FILENAME), {
+        'index': index,
+        'shard_filenames': shard_filenames,
+        'labels_table_checksum': labels_table_checksum(table),
+        'undistort_images': undistort_images
+    })
+
+
+class ImageShards:
+    """
+        Read-only access to jpegs packed by `build_shards()`. Shard files are memory-mapped
+        lazily in each process, so that the object can be cheaply sent to DataLoader workers.
+    """
+    def __init__(self, shards_path):
+        index = np.load(os.path.join(shards_path, INDEX_FILENAME), allow_pickle=True).item()
+
+        self.index = index['index']
+        self.undistort_images = index['undistort_images']
+        self.labels_table_checksum = index['labels_table_checksum']
+        self.shard_paths = [os.path.join(shards_path, filename) for filename in index['shard_filenames']]
+
+        self._shards = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def select(self, selection):
+        """Keeps only rows `selection` (indices or boolean mask) of the index, like `labels['table']`"""
+        self.index = self.index[selection]
+
+    def get(self, idx, camera_idx):
+        """Returns encoded image as a zero-copy uint8 numpy array"""
+        if self._shards is None:
+            self._shards = [np.memmap(path, dtype=np.uint8, mode='r') for path in self.shard_paths]
+
+        shard_id, offset, length = self.index[idx, camera_idx]
+        assert shard_id >= 0, 'view %d of sample %d is not in shards' % (camera_idx, idx)
+
+        return self._shards[shard_id][offset:offset + length]
@@ -1,8 +1,6 @@
 import numpy as np
 import torch
 
-from mvn.utils.img import image_batch_to_torch
-
 def make_collate_fn(randomize_n_views=True, min_n_views=10, max_n_views=31):
 
     def collate_fn(items):
@@ -12,7 +10,7 @@ def make_collate_fn(randomize_n_views=True, min_n_views=10, max_n_views=31):
             return None
 
         batch = dict()
-        total_n_views = min(len(item['images']) for item in items)
+        total_n_views = min(len(item['cameras']) for item in items)
 
         indexes = np.arange(total_n_views)
         if randomize_n_views:
@@ -21,12 +19,18 @@ def make_collate_fn(randomize_n_views=True, min_n_views=10, max_n_views=31):
         else:
             indexes = np.arange(total_n_views)
 
-        batch['images'] = np.stack([np.stack([item['images'][i] for item in items], axis=0) for i in indexes], axis=0).swapaxes(0, 1)
+        if 'images' in items[0]:
+            # images may be a list of arrays if the dataset doesn't resize them
+            batch['images'] = np.stack([np.stack([item['images'][i] for i in indexes], axis=0) for item in items], axis=0)
+        if 'jpegs' in items[0]:
+            # encoded images of different sizes, decoded later (e.g. by DALI)
+            batch['jpegs'] = [[item['jpegs'][i] for i in indexes] for item in items]
         batch['detections'] = np.array([[item['detections'][i] for item in items] for i in indexes]).swapaxes(0, 1)
         batch['cameras'] = [[item['cameras'][i] for item in items] for i in indexes]
 
         batch['keypoints_3d'] = [item['keypoints_3d'] for item in items]
-        # batch['cuboids'] = [item['cuboids'] for item in items]
+        if 'cuboids' in items[0]:
+            batch['cuboids'] = [item['cuboids'] for item in items]
         batch['indexes'] = [item['indexes'] for item in items]
 
         try:
@@ -39,18 +43,29 @@ def make_collate_fn(randomize_n_views=True, min_n_views=10, max_n_views=31):
     return collate_fn
 
 
+def get_missing_views_mask(bbox_by_camera_tlbr):
+    """Convention: if the bbox is empty (zero width), then this view is missing
+
+    Args:
+        bbox_by_camera_tlbr numpy array of shape (..., 4): bboxes (top, left, bottom, right)
+
+    Returns:
+        mask boolean numpy array of shape (...): True for missing views
+    """
+    return bbox_by_camera_tlbr[..., 3] == bbox_by_camera_tlbr[..., 1]
+
+
 def worker_init_fn(worker_id):
     np.random.seed(np.random.get_state()[1][0] + worker_id)
 
 def prepare_batch(batch, device, config, is_train=True):
-    # images
-    images_batch = []
-    for image_batch in batch['images']:
-        image_batch = image_batch_to_torch(image_batch)
-        image_batch = image_batch.to(device)
-        images_batch.append(image_batch)
-
-    images_batch = torch.stack(images_batch, dim=0)
+    # images of shape (batch_size, n_views, 3, height, width)
+    images_batch = batch['images']
+    if not torch.is_tensor(images_batch): # may be decoded by DALI
+        images_batch = torch.from_numpy(images_batch)
+    if images_batch.dtype == torch.uint8: # not normalized by the dataset, BxVxHxWxC -> BxVxCxHxW
+        images_batch = images_batch.permute(0, 1, 4, 2, 3).contiguous()
+    images_batch = images_batch.float().to(device)
 
     # 3D keypoints
     keypoints_3d_batch_gt = torch.from_numpy(np.stack(batch['keypoints_3d'], axis=0)[:, :, :3]).float().to(device)
@@ -1,11 +1,79 @@
+import warnings
+
 import numpy as np
 import cv2
 from PIL import Image
 
 import torch
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
 IMAGENET_MEAN, IMAGENET_STD = np.array([0.485, 0.456, 0.406]), np.array([0.229, 0.224, 0.225])
 
+# (image / 255 - mean) / std == (image - 255 * mean) * (1 / (255 * std)), precomputed for normalize_image()
+_NORM_MEAN_255 = (255.0 * IMAGENET_MEAN).astype(np.float32)
+_NORM_INV_STD_255 = (1.0 / (255.0 * IMAGENET_STD)).astype(np.float32)
+
+_turbojpeg = None  # created lazily, once per process; False if libturbojpeg could not be loaded
+
+
+def _get_turbojpeg():
+    """Returns a per-process TurboJPEG instance, or None if cv2 has to be used instead"""
+    global _turbojpeg
+
+    if TurboJPEG is None:
+        return None
+
+    if _turbojpeg is None:
+        try:
+            _turbojpeg = TurboJPEG()
+        except (RuntimeError, OSError) as error:
+            # PyTurboJPEG is installed, but the native libturbojpeg is not
+            warnings.warn(f"Failed to load libturbojpeg ({error}), decoding jpegs with cv2 instead")
+            _turbojpeg = False
+
+    return _turbojpeg or None
+
+
+def read_image(image_path):
+    """Reads image the same way as cv2.imread(), but decodes jpegs with PyTurboJPEG if it is installed
+
+    Args:
+        image_path str: path to the image
+
+    Returns:
+        image numpy array of shape (height, width, 3): BGR uint8 image
+    """
+    if image_path.lower().endswith(('.jpg', '.jpeg')) and _get_turbojpeg() is not None:
+        with open(image_path, 'rb') as image_file:
+            return decode_image(image_file.read())
+
+    return cv2.imread(image_path)
+
+
+def decode_image(image_buffer):
+    """Decodes jpeg from memory, see read_image()
+
+    Args:
+        image_buffer bytes or uint8 numpy array: encoded image
+
+    Returns:
+        image numpy array of shape (height, width, 3): BGR uint8 image
+    """
+    turbojpeg = _get_turbojpeg()
+    if turbojpeg is not None:
+        return turbojpeg.decode(image_buffer, pixel_format=TJPF_BGR)
+
+    return cv2.imdecode(np.frombuffer(image_buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+
 
 def crop_image(image, bbox):
     """Crops area from image specified as bbox. Always returns area of size as bbox filling missing parts with zeros
@@ -69,6 +137,31 @@ def scale_bbox(bbox, scale):
     return new_left, new_upper, new_right, new_lower
 
 
+def scale_bboxes(bboxes, scale):
+    """Vectorized version of scale_bbox()
+
+    Args:
+        bboxes numpy array of shape (..., 4): input bboxes (left, upper, right, lower)
+        scale float: scale factor
+
+    Returns:
+        scaled_bboxes numpy int32 array of shape (..., 4): resulting bboxes (left, upper, right, lower)
+    """
+    left, upper, right, lower = np.moveaxis(np.asarray(bboxes, dtype=np.int64), -1, 0)
+    width, height = right - left, lower - upper
+
+    x_center, y_center = (right + left) // 2, (lower + upper) // 2
+    new_width, new_height = (scale * width).astype(np.int64), (scale * height).astype(np.int64)
+
+    new_left = x_center - new_width // 2
+    new_right = new_left + new_width
+
+    new_upper = y_center - new_height // 2
+    new_lower = new_upper + new_height
+
+    return np.stack([new_left, new_upper, new_right, new_lower], axis=-1).astype(np.int32)
+
+
 def to_numpy(tensor):
     if torch.is_tensor(tensor):
         return tensor.cpu().detach().numpy()
@@ -99,15 +192,41 @@ def image_batch_to_torch(image_batch):
     return image_batch
 
 
-def normalize_image(image):
+if numba is not None:
+    @numba.njit(nogil=True, fastmath=True, cache=True)
+    def _normalize_image_kernel(image, mean, inv_std, out):
+        height, width, n_channels = image.shape
+        for i in range(height):
+            for j in range(width):
+                for c in range(n_channels):
+                    out[i, j, c] = (image[i, j, c] - mean[c]) * inv_std[c]
+
+
+def normalize_image(image, channels_first=False):
     """Normalizes image using ImageNet mean and std
 
     Args:
         image numpy array of shape (h, w, 3): image
+        channels_first bool: if True, the result is transposed to (3, h, w) in the same pass
 
-    Returns normalized_image numpy array of shape (h, w, 3): normalized image
+    Returns normalized_image float32 numpy array of shape (h, w, 3) or (3, h, w): normalized image
     """
-    return (image / 255.0 - IMAGENET_MEAN) / IMAGENET_STD
+    height, width, n_channels = image.shape
+    if channels_first:
+        normalized_image = np.empty((n_channels, height, width), dtype=np.float32)
+        out = normalized_image.transpose(1, 2, 0) # HxWxC view of CxHxW memory
+    else:
+        normalized_image = np.empty((height, width, n_channels), dtype=np.float32)
+        out = normalized_image
+
+    if numba is not None:
+        # single read + single write pass over the image
+        _normalize_image_kernel(image, _NORM_MEAN_255, _NORM_INV_STD_255, out)
+    else:
+        np.subtract(image, _NORM_MEAN_255, out=out)
+        out *= _NORM_INV_STD_255
+
+    return normalized_image
 
 
 def denormalize_image(image):
@@ -2,6 +2,8 @@ import os
 import yaml
 import json
 import re
+import threading
+from collections import OrderedDict
 
 import torch
 
@@ -28,6 +30,42 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class LRUCache(object):
+    """Thread-safe dict-like cache which keeps at most `capacity` most recently used items"""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def __getstate__(self):
+        # locks can't be pickled (e.g. when DataLoader workers are spawned); start workers with an empty cache
+        return {'capacity': self.capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state['capacity'])
+
+
 def calc_gradient_norm(named_parameters):
     total_norm = 0.0
     for name, p in named_parameters:
@@ -17,7 +17,6 @@ from torch import nn
 from torch import autograd
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from torch.nn.parallel import DistributedDataParallel
 
 from tensorboardX import SummaryWriter
@@ -28,6 +27,7 @@ from mvn.models.loss import KeypointsMSELoss, KeypointsMSESmoothLoss, KeypointsM
 from mvn.utils import img, multiview, op, vis, misc, cfg
 from mvn.datasets import human36m
 from mvn.datasets import utils as dataset_utils
+from mvn.datasets import dali as dataset_dali
 
 
 def parse_args():
@@ -47,9 +47,12 @@ def parse_args():
 
 
 def setup_human36m_dataloaders(config, is_train, distributed_train):
+    dali_device_id = torch.cuda.current_device() if torch.cuda.is_available() else None
+
     train_dataloader = None
     if is_train:
         # train
+        use_dali = config.dataset.train.use_dali if hasattr(config.dataset.train, "use_dali") else False
         train_dataset = human36m.Human36MMultiViewDataset(
             h36m_root=config.dataset.train.h36m_root,
             pred_results_path=config.dataset.train.pred_results_path if hasattr(config.dataset.train, "pred_results_path") else None,
@@ -63,11 +66,14 @@ def setup_human36m_dataloaders(config, is_train, distributed_train):
             undistort_images=config.dataset.train.undistort_images,
             ignore_cameras=config.dataset.train.ignore_cameras if hasattr(config.dataset.train, "ignore_cameras") else [],
             crop=config.dataset.train.crop if hasattr(config.dataset.train, "crop") else True,
+            load_images=not use_dali,
+            image_cache_capacity=config.dataset.train.image_cache_capacity if hasattr(config.dataset.train, "image_cache_capacity") else 0,
+            shards_path=config.dataset.train.shards_path if hasattr(config.dataset.train, "shards_path") else None,
         )
 
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset) if distributed_train else None
 
-        train_dataloader = DataLoader(
+        train_dataloader = human36m.Human36MMultiViewDataset.make_dataloader(
             train_dataset,
             batch_size=config.opt.batch_size,
             shuffle=config.dataset.train.shuffle and (train_sampler is None), # debatable
@@ -80,7 +86,11 @@ def setup_human36m_dataloaders(config, is_train, distributed_train):
             pin_memory=True
         )
 
+        if use_dali:
+            train_dataloader = dataset_dali.DALIMultiViewLoader(train_dataloader, device_id=dali_device_id)
+
     # val
+    use_dali = config.dataset.val.use_dali if hasattr(config.dataset.val, "use_dali") else False
     val_dataset = human36m.Human36MMultiViewDataset(
         h36m_root=config.dataset.val.h36m_root,
         pred_results_path=config.dataset.val.pred_results_path if hasattr(config.dataset.val, "pred_results_path") else None,
@@ -95,9 +105,12 @@ def setup_human36m_dataloaders(config, is_train, distributed_train):
         undistort_images=config.dataset.val.undistort_images,
         ignore_cameras=config.dataset.val.ignore_cameras if hasattr(config.dataset.val, "ignore_cameras") else [],
         crop=config.dataset.val.crop if hasattr(config.dataset.val, "crop") else True,
+        load_images=not use_dali,
+        image_cache_capacity=config.dataset.val.image_cache_capacity if hasattr(config.dataset.val, "image_cache_capacity") else 0,
+        shards_path=config.dataset.val.shards_path if hasattr(config.dataset.val, "shards_path") else None,
     )
 
-    val_dataloader = DataLoader(
+    val_dataloader = human36m.Human36MMultiViewDataset.make_dataloader(
         val_dataset,
         batch_size=config.opt.val_batch_size if hasattr(config.opt, "val_batch_size") else config.opt.batch_size,
         shuffle=config.dataset.val.shuffle,
@@ -109,6 +122,9 @@ def setup_human36m_dataloaders(config, is_train, distributed_train):
         pin_memory=True
     )
 
+    if use_dali:
+        val_dataloader = dataset_dali.DALIMultiViewLoader(val_dataloader, device_id=dali_device_id)
+
     return train_dataloader, val_dataloader, train_sampler
 
 